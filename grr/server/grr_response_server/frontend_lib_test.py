@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 """Tests for frontend server, client communicator, and the GRRHTTPClient."""
 
-import array
 import datetime
 import logging
+import operator
 import pdb
 import time
 from unittest import mock
@@ -68,6 +68,18 @@ class SendingTestFlow(flow_base.FlowBase):
 
 MESSAGE_EXPIRY_TIME = 100
 
+# Session ids of the messages exchanged in ClientServerCommunicate.
+_FLOW_SESSION_IDS = [
+    rdfvalue.SessionID(base="aff4:/flows", queue=queues.FLOWS, flow_name=i)
+    for i in range(1, 11)
+]
+
+# Session id used for the messages exchanged by the HTTP client tests.
+_HTTP_SESSION_ID = rdfvalue.SessionID("W:session")
+
+# Basename of the session id clients send enrolment requests to.
+_ENROLMENT_SESSION_NAME = "E:%s" % ca_enroller.EnrolmentHandler.handler_name
+
 
 def ReceiveMessages(client_id, messages):
   server = TestServer()
@@ -81,6 +93,25 @@ def TestServer():
       message_expiry_time=MESSAGE_EXPIRY_TIME)
 
 
+# Signing a client certificate is dominated by RSA operations and the tests only
+# ever use a couple of distinct client keys, so certificates are cached by the
+# serialized private key. Note that a cached certificate keeps the validity
+# window from its first signing, also when it is reused within a test (e.g. by
+# `CreateNewServerCommunicator` in `testReboots`).
+_CLIENT_CERTS = {}
+
+
+def _CachedClientCert(private_key):
+  """Returns a (cached) client certificate for the given private key."""
+  key = private_key.SerializeToBytes()
+  if key not in _CLIENT_CERTS:
+    common_name = rdf_client.ClientURN.FromPrivateKey(private_key)
+    csr = rdf_crypto.CertificateSigningRequest(
+        common_name=common_name, private_key=private_key)
+    _CLIENT_CERTS[key] = rdf_crypto.RDFX509Cert.ClientCertFromCSR(csr)
+  return _CLIENT_CERTS[key]
+
+
 class GRRFEServerTestRelational(flow_test_lib.FlowTestsBaseclass):
   """Tests the GRRFEServer with relational flows enabled."""
 
@@ -123,17 +154,14 @@ class GRRFEServerTestRelational(flow_test_lib.FlowTestsBaseclass):
     self.assertEqual(received[0][0], req)
     self.assertLen(received[0][1], 9)
 
-  def testBlobHandlerMessagesAreHandledOnTheFrontend(self):
+  def _ReceiveBlob(self, data_blob):
+    """Sends a TransferStore message with the given blob to the frontend."""
     client_id = "C.1234567890123456"
     data_store.REL_DB.WriteClientMetadata(client_id, fleetspeak_enabled=False)
 
     # Check that the worker queue is empty.
     self.assertEmpty(data_store.REL_DB.ReadMessageHandlerRequests())
 
-    data = b"foo"
-    data_blob = rdf_protodict.DataBlob(
-        data=zlib.compress(data),
-        compression=rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION)
     messages = [
         rdf_flows.GrrMessage(
             source=client_id,
@@ -147,10 +175,31 @@ class GRRFEServerTestRelational(flow_test_lib.FlowTestsBaseclass):
     # Check that the worker queue is still empty.
     self.assertEmpty(data_store.REL_DB.ReadMessageHandlerRequests())
 
+  def testBlobHandlerMessagesAreHandledOnTheFrontend(self):
+    data = b"foo"
+    self._ReceiveBlob(
+        rdf_protodict.DataBlob(
+            data=zlib.compress(data),
+            compression=rdf_protodict.DataBlob.CompressionType.ZCOMPRESSION))
+
     # Check that the blob was written to the blob store.
     self.assertTrue(
         data_store.BLOBS.CheckBlobExists(rdf_objects.BlobID.FromBlobData(data)))
 
+  def testBlobHandlerUncompressedMessagesAreHandledOnTheFrontend(self):
+    # Compressing tiny payloads only makes them bigger, so they may be sent
+    # as-is.
+    data = b"foo"
+    with mock.patch.object(zlib, "decompress") as decompress:
+      self._ReceiveBlob(
+          rdf_protodict.DataBlob(
+              data=data,
+              compression=rdf_protodict.DataBlob.CompressionType.UNCOMPRESSED))
+
+    decompress.assert_not_called()
+    self.assertTrue(
+        data_store.BLOBS.CheckBlobExists(rdf_objects.BlobID.FromBlobData(data)))
+
   def testCrashReport(self):
     client_id = "C.1234567890123456"
     flow_id = "12345678"
@@ -191,20 +240,20 @@ class GRRFEServerTestRelational(flow_test_lib.FlowTestsBaseclass):
         create_time=rdfvalue.RDFDatetime.Now())
     data_store.REL_DB.WriteFlowObject(rdf_flow)
 
-    action_requests = []
-    for i in range(3):
-      data_store.REL_DB.WriteFlowRequests([
-          rdf_flow_objects.FlowRequest(
-              client_id=client_id, flow_id=flow_id, request_id=i)
-      ])
-
-      action_requests.append(
-          rdf_flows.ClientActionRequest(
-              client_id=client_id,
-              flow_id=flow_id,
-              request_id=i,
-              action_identifier="WmiQuery"))
-
+    flow_requests = [
+        rdf_flow_objects.FlowRequest(
+            client_id=client_id, flow_id=flow_id, request_id=i)
+        for i in range(3)
+    ]
+    data_store.REL_DB.WriteFlowRequests(flow_requests)
+
+    action_requests = [
+        rdf_flows.ClientActionRequest(
+            client_id=client_id,
+            flow_id=flow_id,
+            request_id=i,
+            action_identifier="WmiQuery") for i in range(3)
+    ]
     data_store.REL_DB.WriteClientActionRequests(action_requests)
     server = TestServer()
 
@@ -266,12 +315,13 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
 
     self.server_certificate = config.CONFIG["Frontend.certificate"]
     self.server_private_key = config.CONFIG["PrivateKeys.server_key"]
+    self.ca_certificate = config.CONFIG["CA.certificate"]
     self.client_communicator = comms.ClientCommunicator(
         private_key=self.client_private_key)
 
     self.client_communicator.LoadServerCertificate(
         server_certificate=self.server_certificate,
-        ca_certificate=config.CONFIG["CA.certificate"])
+        ca_certificate=self.ca_certificate)
 
     self.last_urlmock_error = None
 
@@ -282,44 +332,52 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
         certificate=self.server_certificate,
         private_key=self.server_private_key)
 
-  def ClientServerCommunicate(self, timestamp=None):
-    """Tests the end to end encrypted communicators."""
+  def ClientServerCommunicate(self, timestamp=None, serialize=False):
+    """Tests the end to end encrypted communicators.
+
+    Args:
+      timestamp: The timestamp the client uses to encode the messages.
+      serialize: If set, the encoded messages are serialized (and kept in
+        `self.cipher_text`) and the server decodes them from the wire format.
+        Otherwise the ClientCommunication is handed to the server directly.
+
+    Returns:
+      The messages decoded by the server.
+    """
     message_list = rdf_flows.MessageList()
-    for i in range(1, 11):
-      message_list.job.Append(
-          session_id=rdfvalue.SessionID(
-              base="aff4:/flows", queue=queues.FLOWS, flow_name=i),
-          name="OMG it's a string")
+    message_list.job.Extend(
+        rdf_flows.GrrMessage(session_id=session_id, name="OMG it's a string")
+        for session_id in _FLOW_SESSION_IDS)
 
     result = rdf_flows.ClientCommunication()
     timestamp = self.client_communicator.EncodeMessages(
         message_list, result, timestamp=timestamp)
-    self.cipher_text = result.SerializeToBytes()
-
-    (decoded_messages, source, client_timestamp) = (
-        self.server_communicator.DecryptMessage(self.cipher_text))
+    if serialize:
+      self.cipher_text = result.SerializeToBytes()
+      (decoded_messages, source, client_timestamp) = (
+          self.server_communicator.DecryptMessage(self.cipher_text))
+    else:
+      (decoded_messages, source, client_timestamp) = (
+          self.server_communicator.DecodeMessages(result))
 
     self.assertEqual(source, self.client_communicator.common_name)
     self.assertEqual(client_timestamp, timestamp)
     self.assertLen(decoded_messages, 10)
-    for i in range(1, 11):
-      self.assertEqual(
-          decoded_messages[i - 1].session_id,
-          rdfvalue.SessionID(
-              base="aff4:/flows", queue=queues.FLOWS, flow_name=i))
+    for message, session_id in zip(decoded_messages, _FLOW_SESSION_IDS):
+      self.assertEqual(message.session_id, session_id)
 
     return decoded_messages
 
   def testCommunications(self):
     """Test that messages from unknown clients are tagged unauthenticated."""
     decoded_messages = self.ClientServerCommunicate()
-    for i in range(len(decoded_messages)):
-      self.assertEqual(decoded_messages[i].auth_state,
-                       rdf_flows.GrrMessage.AuthorizationState.UNAUTHENTICATED)
+    unauthenticated = rdf_flows.GrrMessage.AuthorizationState.UNAUTHENTICATED
+    for message in decoded_messages:
+      self.assertEqual(message.auth_state, unauthenticated)
 
   def _MakeClientRecord(self):
     """Make a client in the data store."""
-    client_cert = self.ClientCertFromPrivateKey(self.client_private_key)
+    client_cert = _CachedClientCert(self.client_private_key)
     self.client_id = client_cert.GetCN()[len("aff4:/"):]
     data_store.REL_DB.WriteClientMetadata(
         self.client_id, fleetspeak_enabled=False, certificate=client_cert)
@@ -331,9 +389,9 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
     # Now the server should know about it
     decoded_messages = self.ClientServerCommunicate()
 
-    for i in range(len(decoded_messages)):
-      self.assertEqual(decoded_messages[i].auth_state,
-                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+    authenticated = rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
+    for message in decoded_messages:
+      self.assertEqual(message.auth_state, authenticated)
 
   def testClientPingAndClockIsUpdated(self):
     """Check PING and CLOCK are updated."""
@@ -378,7 +436,8 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
     self._MakeClientRecord()
 
     # First send some messages to the server
-    decoded_messages = self.ClientServerCommunicate(timestamp=1000000)
+    decoded_messages = self.ClientServerCommunicate(
+        timestamp=1000000, serialize=True)
 
     encrypted_messages = self.cipher_text
 
@@ -393,7 +452,8 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
                      rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
 
     # Move the client time more than 1h forward.
-    self.ClientServerCommunicate(timestamp=1000000 + 3700 * 1000000)
+    self.ClientServerCommunicate(
+        timestamp=1000000 + 3700 * 1000000, serialize=True)
 
     # And replay the old messages again.
     (decoded_messages, _,
@@ -410,7 +470,7 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
     with mock.patch.object(
         rdf_crypto.RDFX509Cert, "Verify", lambda self, public_key=None: True):
       self.client_communicator.LoadServerCertificate(
-          self.server_certificate, config.CONFIG["CA.certificate"])
+          self.server_certificate, self.ca_certificate)
 
     def Verify(_, public_key=False):
       _ = public_key
@@ -420,7 +480,7 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
     with mock.patch.object(rdf_crypto.RDFX509Cert, "Verify", Verify):
       self.assertRaises(IOError, self.client_communicator.LoadServerCertificate,
                         self.server_certificate,
-                        config.CONFIG["CA.certificate"])
+                        self.ca_certificate)
 
   def testErrorDetection(self):
     """Tests the end to end encrypted communicators."""
@@ -443,14 +503,14 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
     # 3) The modification may affect the signature resulting in UNAUTHENTICATED
     #    messages.
     # 4) The modification may have no effect on the data at all.
+    mod_cipher_text = bytearray(cipher_text)
     for x in range(0, len(cipher_text), 50):
       # Futz with the cipher text (Make sure it's really changed)
-      mod = chr((cipher_text[x] % 250) + 1).encode("latin-1")
-      mod_cipher_text = cipher_text[:x] + mod + cipher_text[x + 1:]
+      mod_cipher_text[x] = (cipher_text[x] % 250) + 1
 
       try:
         decoded, client_id, _ = self.server_communicator.DecryptMessage(
-            mod_cipher_text)
+            bytes(mod_cipher_text))
 
         for i, message in enumerate(decoded):
           # If the message is actually authenticated it must not be changed!
@@ -468,12 +528,14 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
       except communicator.DecodingError as e:
         logging.debug("Detected alteration at %s: %s", x, e)
 
+      mod_cipher_text[x] = cipher_text[x]
+
   def testEnrollingCommunicator(self):
     """Test that the ClientCommunicator generates good keys."""
     self.client_communicator = comms.ClientCommunicator()
 
     self.client_communicator.LoadServerCertificate(
-        self.server_certificate, config.CONFIG["CA.certificate"])
+        self.server_certificate, self.ca_certificate)
 
     # Verify that the CN is of the correct form
     csr = self.client_communicator.GetCSR()
@@ -484,10 +546,10 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
     self._MakeClientRecord()
 
     # Now the server should know about the client.
-    decoded_messages = self.ClientServerCommunicate()
-    for i in range(len(decoded_messages)):
-      self.assertEqual(decoded_messages[i].auth_state,
-                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+    decoded_messages = self.ClientServerCommunicate(serialize=True)
+    authenticated = rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
+    for message in decoded_messages:
+      self.assertEqual(message.auth_state, authenticated)
 
     # Suppress the output.
     with mock.patch.object(maintenance_utils, "EPrint", lambda msg: None):
@@ -505,15 +567,15 @@ class ClientCommsTest(stats_test_lib.StatsTestMixin,
     # Clients can't connect at this point since they use the outdated
     # session key.
     with self.assertRaises(communicator.DecryptionError):
-      self.ClientServerCommunicate()
+      self.ClientServerCommunicate(serialize=True)
 
     # After the client reloads the server cert, this should start
     # working again.
     self.client_communicator.LoadServerCertificate(
         server_certificate=server_certificate,
-        ca_certificate=config.CONFIG["CA.certificate"])
+        ca_certificate=self.ca_certificate)
 
-    self.assertLen(list(self.ClientServerCommunicate()), 10)
+    self.assertLen(list(self.ClientServerCommunicate(serialize=True)), 10)
 
 
 class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
@@ -531,6 +593,9 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
 
     self.server_private_key = config.CONFIG["PrivateKeys.server_key"]
     self.server_certificate = config.CONFIG["Frontend.certificate"]
+    self.ca_certificate = config.CONFIG["CA.certificate"]
+    # Served to clients fetching "server.pem" in UrlMock.
+    self.server_certificate_pem = str(self.server_certificate).encode("ascii")
 
     # Make a new client
     self.CreateNewClientObject()
@@ -552,10 +617,10 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
 
     # Response to send back to clients.
     self.server_response = dict(
-        session_id="aff4:/W:session", name="Echo", response_id=2)
+        session_id=_HTTP_SESSION_ID, name="Echo", response_id=2)
 
   def _MakeClient(self):
-    self.client_certificate = self.ClientCertFromPrivateKey(
+    self.client_certificate = _CachedClientCert(
         config.CONFIG["Client.private_key"])
     self.client_cn = self.client_certificate.GetCN()
     self.client_id = self.client_cn[len("aff4:/"):]
@@ -576,7 +641,7 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
 
   def CreateClientCommunicator(self):
     self.client_communicator = comms.GRRHTTPClient(
-        ca_cert=config.CONFIG["CA.certificate"],
+        ca_cert=self.ca_certificate,
         worker_cls=worker_mocks.ClientWorker)
 
   def CreateNewClientObject(self):
@@ -588,15 +653,14 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
 
     # Build a client context with preloaded server certificates
     self.client_communicator.communicator.LoadServerCertificate(
-        self.server_certificate, config.CONFIG["CA.certificate"])
+        self.server_certificate, self.ca_certificate)
 
     self.client_communicator.http_manager.retry_error_limit = 5
 
   def UrlMock(self, num_messages=10, url=None, data=None, **kwargs):
     """A mock for url handler processing from the server's POV."""
     if "server.pem" in url:
-      cert = str(config.CONFIG["Frontend.certificate"]).encode("ascii")
-      return MakeResponse(200, cert)
+      return MakeResponse(200, self.server_certificate_pem)
 
     _ = kwargs
     try:
@@ -610,8 +674,8 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
       # Make sure the messages are correct
       self.assertEqual(source, self.client_cn)
       messages = sorted(
-          [m for m in self.messages if m.session_id == "aff4:/W:session"],
-          key=lambda m: m.response_id)
+          [m for m in self.messages if m.session_id == _HTTP_SESSION_ID],
+          key=operator.attrgetter("response_id"))
       self.assertEqual([m.response_id for m in messages],
                        list(range(len(messages))))
       self.assertEqual([m.request_id for m in messages], [1] * len(messages))
@@ -619,8 +683,9 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
       # Now prepare a response
       response_comms = rdf_flows.ClientCommunication()
       message_list = rdf_flows.MessageList()
-      for i in range(0, num_messages):
-        message_list.job.Append(request_id=i, **self.server_response)
+      message_list.job.Extend(
+          rdf_flows.GrrMessage(request_id=i, **self.server_response)
+          for i in range(num_messages))
 
       # Preserve the timestamp as a nonce
       self.server_communicator.EncodeMessages(
@@ -653,7 +718,7 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
       self.assertEqual(message.source, "aff4:/GRR Test Server")
       self.assertEqual(message.response_id, 2)
       self.assertEqual(message.request_id, i)
-      self.assertEqual(message.session_id, "aff4:/W:session")
+      self.assertEqual(message.session_id, _HTTP_SESSION_ID)
       self.assertEqual(message.auth_state,
                        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
 
@@ -666,7 +731,7 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
     for i in range(0, 10):
       self.client_communicator.client_worker.SendReply(
           rdf_flows.GrrStatus(),
-          session_id=rdfvalue.SessionID("W:session"),
+          session_id=_HTTP_SESSION_ID,
           response_id=i,
           request_id=1)
 
@@ -696,7 +761,7 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
       # Client should generate enrollment message by itself.
       self.assertLen(self.messages, 1)
       self.assertEqual(self.messages[0].session_id.Basename(),
-                       "E:%s" % ca_enroller.EnrolmentHandler.handler_name)
+                       _ENROLMENT_SESSION_NAME)
 
   def testEnrollment(self):
     """Test the http response to unknown clients."""
@@ -720,9 +785,8 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
     self.assertLen(self.messages, 11)
     enrolment_messages = []
 
-    expected_id = "E:%s" % ca_enroller.EnrolmentHandler.handler_name
     for m in self.messages:
-      if m.session_id.Basename() == expected_id:
+      if m.session_id.Basename() == _ENROLMENT_SESSION_NAME:
         enrolment_messages.append(m)
 
     self.assertLen(enrolment_messages, 1)
@@ -763,7 +827,7 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
 
     self.assertLen(self.messages, 1)
     self.assertEqual(self.messages[0].session_id.Basename(),
-                     "E:%s" % ca_enroller.EnrolmentHandler.handler_name)
+                     _ENROLMENT_SESSION_NAME)
 
     request = rdf_objects.MessageHandlerRequest(
         client_id=self.messages[0].source.Basename(),
@@ -801,7 +865,7 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
 
   def _CheckFastPoll(self, require_fastpoll, expected_sleeptime):
     self.server_response = dict(
-        session_id="aff4:/W:session",
+        session_id=_HTTP_SESSION_ID,
         name="Echo",
         response_id=2,
         require_fastpoll=require_fastpoll)
@@ -850,24 +914,24 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
           # This converts encryption keys to a string so we can corrupt them.
           field_data = field_data.SerializeToBytes()
 
-        modified_data = array.array("B", field_data)
+        modified_data = bytearray(field_data)
         offset = len(field_data) // 2
-        char = field_data[offset]
-        modified_data[offset] = char % 250 + 1
+        modified_data[offset] = field_data[offset] % 250 + 1
         setattr(self.client_communication, self.corruptor_field,
-                modified_data.tobytes())
+                bytes(modified_data))
 
         # Make sure we actually changed the data.
         self.assertNotEqual(field_data, modified_data)
 
         mod_str_repr = self.client_communication.SerializeToBytes()
         self.assertLen(orig_str_repr, len(mod_str_repr))
-        differences = [
-            True for x, y in zip(orig_str_repr, mod_str_repr) if x != y
-        ]
-        self.assertLen(differences, 1)
+        differences = sum(x != y for x, y in zip(orig_str_repr, mod_str_repr))
+        self.assertEqual(differences, 1)
+
+        data = mod_str_repr
+      else:
+        data = self.client_communication.SerializeToBytes()
 
-      data = self.client_communication.SerializeToBytes()
       return self.UrlMock(url=url, data=data, **kwargs)
 
     with mock.patch.object(requests, "request", Corruptor):
@@ -943,26 +1007,26 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
     self.client_communicator.client_worker.stats_collector._last_send_time = (
         rdfvalue.RDFDatetime.FromSecondsSinceEpoch(now))
 
-    with test_lib.FakeTime(now):
+    runs = []
+    with test_lib.FakeTime(now) as clock:
       self.client_communicator.client_worker.stats_collector._Send()
 
-    runs = []
-    with mock.patch.object(admin.GetClientStatsAuto, "Run",
-                           lambda cls, _: runs.append(1)):
+      with mock.patch.object(admin.GetClientStatsAuto, "Run",
+                             lambda cls, _: runs.append(1)):
 
-      # No stats collection after 10 minutes.
-      with test_lib.FakeTime(now + 600):
+        # No stats collection after 10 minutes.
+        clock.time = now + 600
         self.client_communicator.client_worker.stats_collector._Send()
         self.assertEmpty(runs)
 
-      # Let one hour pass.
-      with test_lib.FakeTime(now + 3600):
+        # Let one hour pass.
+        clock.time = now + 3600
         self.client_communicator.client_worker.stats_collector._Send()
         # This time the client should collect stats.
         self.assertLen(runs, 1)
 
-      # Let one hour and ten minutes pass.
-      with test_lib.FakeTime(now + 3600 + 600):
+        # Let one hour and ten minutes pass.
+        clock.time = now + 3600 + 600
         self.client_communicator.client_worker.stats_collector._Send()
         # Again, there should be no stats collection, as last collection
         # happened less than an hour ago.
@@ -976,32 +1040,32 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
         rdfvalue.RDFDatetime.FromSecondsSinceEpoch(now))
     self.client_communicator.client_worker._is_active = True
 
-    with test_lib.FakeTime(now):
+    runs = []
+    with test_lib.FakeTime(now) as clock:
       self.client_communicator.client_worker.stats_collector._Send()
 
-    runs = []
-    with mock.patch.object(admin.GetClientStatsAuto, "Run",
-                           lambda cls, _: runs.append(1)):
+      with mock.patch.object(admin.GetClientStatsAuto, "Run",
+                             lambda cls, _: runs.append(1)):
 
-      # No stats collection after 30 seconds.
-      with test_lib.FakeTime(now + 30):
+        # No stats collection after 30 seconds.
+        clock.time = now + 30
         self.client_communicator.client_worker.stats_collector._Send()
         self.assertEmpty(runs)
 
-      # Let 61 seconds pass.
-      with test_lib.FakeTime(now + 61):
+        # Let 61 seconds pass.
+        clock.time = now + 61
         self.client_communicator.client_worker.stats_collector._Send()
         # This time the client should collect stats.
         self.assertLen(runs, 1)
 
-      # No stats collection within one minute from the last time.
-      with test_lib.FakeTime(now + 61 + 59):
+        # No stats collection within one minute from the last time.
+        clock.time = now + 61 + 59
         self.client_communicator.client_worker.stats_collector._Send()
         self.assertLen(runs, 1)
 
-      # Stats collection happens as more than one minute has passed since the
-      # last one.
-      with test_lib.FakeTime(now + 61 + 61):
+        # Stats collection happens as more than one minute has passed since
+        # the last one.
+        clock.time = now + 61 + 61
         self.client_communicator.client_worker.stats_collector._Send()
         self.assertLen(runs, 2)
 
@@ -1012,31 +1076,31 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
     self.client_communicator.client_worker.stats_collector._last_send_time = (
         rdfvalue.RDFDatetime.FromSecondsSinceEpoch(now))
 
-    with test_lib.FakeTime(now):
+    runs = []
+    with test_lib.FakeTime(now) as clock:
       self.client_communicator.client_worker.stats_collector._Send()
 
-    runs = []
-    with mock.patch.object(admin.GetClientStatsAuto, "Run",
-                           lambda cls, _: runs.append(1)):
+      with mock.patch.object(admin.GetClientStatsAuto, "Run",
+                             lambda cls, _: runs.append(1)):
 
-      # No stats collection after 30 seconds.
-      with test_lib.FakeTime(now + 30):
+        # No stats collection after 30 seconds.
+        clock.time = now + 30
         self.client_communicator.client_worker.stats_collector._Send()
         self.assertEmpty(runs)
 
-      msg = rdf_flows.GrrMessage(
-          name=standard.HashFile.__name__, generate_task_id=True)
-      self.client_communicator.client_worker.HandleMessage(msg)
+        msg = rdf_flows.GrrMessage(
+            name=standard.HashFile.__name__, generate_task_id=True)
+        self.client_communicator.client_worker.HandleMessage(msg)
 
-      # HandleMessage was called, but one minute hasn't passed, so
-      # stats should not be sent.
-      with test_lib.FakeTime(now + 59):
+        # HandleMessage was called, but one minute hasn't passed, so
+        # stats should not be sent.
+        clock.time = now + 59
         self.client_communicator.client_worker.stats_collector._Send()
         self.assertEmpty(runs)
 
-      # HandleMessage was called more than one minute ago, so stats
-      # should be sent.
-      with test_lib.FakeTime(now + 61):
+        # HandleMessage was called more than one minute ago, so stats
+        # should be sent.
+        clock.time = now + 61
         self.client_communicator.client_worker.stats_collector._Send()
         self.assertLen(runs, 1)
 
@@ -1059,9 +1123,12 @@ class HTTPClientTests(client_action_test_lib.WithAllClientActionsMixin,
 
 class FrontEndServerTest(absltest.TestCase):
 
-  def setUp(self):
-    super().setUp()
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
 
+    # Generating an RSA key is expensive and none of the tests depend on the
+    # key itself, so we do it only once for all of them.
     private_key = rsa.generate_private_key(65537, 2048)
     certificate = x509.CertificateBuilder(
         subject_name=x509.Name([
@@ -1076,19 +1143,24 @@ class FrontEndServerTest(absltest.TestCase):
         public_key=private_key.public_key(),
     ).sign(private_key, hashes.SHA256())
 
-    rdf_private_key = rdf_crypto.RSAPrivateKey(private_key)
-    rdf_certificate = rdf_crypto.RDFX509Cert(certificate)
+    cls.private_key = rdf_crypto.RSAPrivateKey(private_key)
+    cls.certificate = rdf_crypto.RDFX509Cert(certificate)
+
+  def setUp(self):
+    super().setUp()
 
     self.server = frontend_lib.FrontEndServer(
-        private_key=rdf_private_key,
-        certificate=rdf_certificate,
+        private_key=self.private_key,
+        certificate=self.certificate,
     )
 
-  @db_test_lib.WithDatabase
-  def testReceiveRRGResponseStatusOK(self, db: abstract_db.Database):
-    client_id = db_test_utils.InitializeClient(db)
-    flow_id = db_test_utils.InitializeFlow(db, client_id)
-
+  def _WriteFlowRequestAndCreateResponse(
+      self,
+      db: abstract_db.Database,
+      client_id: str,
+      flow_id: str,
+  ) -> rrg_pb2.Response:
+    """Writes a flow request and returns an RRG response skeleton for it."""
     flow_request = rdf_flow_objects.FlowRequest()
     flow_request.client_id = client_id
     flow_request.flow_id = flow_id
@@ -1097,8 +1169,16 @@ class FrontEndServerTest(absltest.TestCase):
 
     response = rrg_pb2.Response()
     response.flow_id = int(flow_id, 16)
-    response.request_id = 1337
+    response.request_id = flow_request.request_id
     response.response_id = 42
+    return response
+
+  @db_test_lib.WithDatabase
+  def testReceiveRRGResponseStatusOK(self, db: abstract_db.Database):
+    client_id = db_test_utils.InitializeClient(db)
+    flow_id = db_test_utils.InitializeFlow(db, client_id)
+
+    response = self._WriteFlowRequestAndCreateResponse(db, client_id, flow_id)
     response.status.network_bytes_sent = 4 * 1024 * 1024
 
     self.server.ReceiveRRGResponse(client_id, response)
@@ -1124,16 +1204,7 @@ class FrontEndServerTest(absltest.TestCase):
     client_id = db_test_utils.InitializeClient(db)
     flow_id = db_test_utils.InitializeFlow(db, client_id)
 
-    flow_request = rdf_flow_objects.FlowRequest()
-    flow_request.client_id = client_id
-    flow_request.flow_id = flow_id
-    flow_request.request_id = 1337
-    db.WriteFlowRequests([flow_request])
-
-    response = rrg_pb2.Response()
-    response.flow_id = int(flow_id, 16)
-    response.request_id = 1337
-    response.response_id = 42
+    response = self._WriteFlowRequestAndCreateResponse(db, client_id, flow_id)
     response.status.error.type = rrg_pb2.Status.Error.UNSUPPORTED_ACTION
     response.status.error.message = "foobar"
 
@@ -1160,16 +1231,7 @@ class FrontEndServerTest(absltest.TestCase):
     client_id = db_test_utils.InitializeClient(db)
     flow_id = db_test_utils.InitializeFlow(db, client_id)
 
-    flow_request = rdf_flow_objects.FlowRequest()
-    flow_request.client_id = client_id
-    flow_request.flow_id = flow_id
-    flow_request.request_id = 1337
-    db.WriteFlowRequests([flow_request])
-
-    response = rrg_pb2.Response()
-    response.flow_id = int(flow_id, 16)
-    response.request_id = 1337
-    response.response_id = 42
+    response = self._WriteFlowRequestAndCreateResponse(db, client_id, flow_id)
     response.result.Pack(wrappers_pb2.StringValue(value="foobar"))
 
     self.server.ReceiveRRGResponse(client_id, response)
@@ -1193,16 +1255,7 @@ class FrontEndServerTest(absltest.TestCase):
     client_id = db_test_utils.InitializeClient(db)
     flow_id = db_test_utils.InitializeFlow(db, client_id)
 
-    flow_request = rdf_flow_objects.FlowRequest()
-    flow_request.client_id = client_id
-    flow_request.flow_id = flow_id
-    flow_request.request_id = 1337
-    db.WriteFlowRequests([flow_request])
-
-    response = rrg_pb2.Response()
-    response.flow_id = int(flow_id, 16)
-    response.request_id = 1337
-    response.response_id = 42
+    response = self._WriteFlowRequestAndCreateResponse(db, client_id, flow_id)
 
     with self.assertRaisesRegex(ValueError, "Unexpected response"):
       self.server.ReceiveRRGResponse(client_id, response)